@@ -1,17 +1,20 @@
 import streamlit as st
-from mutagen.mp3 import MP3
-from mutagen.flac import FLAC
-from mutagen.oggvorbis import OggVorbis
-from mutagen.wave import WAVE
-from mutagen.id3 import ID3NoHeaderError
-from mutagen import File as MutagenFile
+# mutagen, PIL and requests are imported lazily inside the helpers that need
+# them: cold start only pays for what the user actually does, and a URL-only
+# session never loads the picture-parsing machinery at all.
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
 import io
+import logging
 import os
+import pickle
+import sqlite3
 import time
-from datetime import datetime, timedelta
-import requests
 import random # For shuffle
 
+logger = logging.getLogger(__name__)
+
 # --- Page Configuration ---
 st.set_page_config(
     page_title="Advanced Music Player Pro",
@@ -21,96 +24,311 @@ st.set_page_config(
 )
 
 # --- Helper Functions ---
+_AUDIO_MIME = {'mp3': 'audio/mpeg', 'wav': 'audio/wav', 'ogg': 'audio/ogg', 'flac': 'audio/flac'}
+
+def get_mime_type(filename):
+    """Maps a filename's extension to its audio MIME type for st.audio."""
+    ext = filename.lower().split('.')[-1] if isinstance(filename, str) else ''
+    return _AUDIO_MIME.get(ext, 'audio/basic')
+
+@st.cache_data(show_spinner=False)
+def _thumbnail(art_bytes):
+    """Decodes embedded cover art once and returns a small 200x200 PNG.
+
+    Embedded pictures (especially in FLAC) are often multi-MB; shipping them
+    to the browser on every rerun dwarfs the rest of the page payload.
+    """
+    from PIL import Image
+    img = Image.open(io.BytesIO(art_bytes)).convert('RGB')
+    img.thumbnail((200, 200))
+    buf = io.BytesIO()
+    img.save(buf, 'PNG', optimize=True)
+    return buf.getvalue()
+
+def _read_content(file_obj):
+    """Reads the full bytes of a file-like object, leaving the cursor at 0."""
+    if hasattr(file_obj, 'seek'):
+        file_obj.seek(0)
+    content = file_obj.getvalue() if isinstance(file_obj, io.BytesIO) else file_obj.read()
+    if hasattr(file_obj, 'seek'):
+        file_obj.seek(0)
+    return content
+
+def _content_key(content):
+    """Cheap cache key: hash of the first 64 KB plus the total size."""
+    return hashlib.blake2b(
+        content[:65536] + len(content).to_bytes(8, 'little'), digest_size=16
+    ).digest()
+
+_META_DB_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'music_player', 'meta.db')
+
+@st.cache_resource(show_spinner=False)
+def _meta_db():
+    """Opens the on-disk metadata cache, creating it on first use.
+
+    st.cache_data only lives in memory, so re-uploading the same folder in a
+    new session re-parsed every file. This SQLite table persists parsed
+    metadata across sessions; check_same_thread=False because ingestion runs
+    in a thread pool (Python's sqlite3 serializes access itself).
+    """
+    os.makedirs(os.path.dirname(_META_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(_META_DB_PATH, isolation_level=None, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS meta(key BLOB PRIMARY KEY, pickle BLOB)")
+    return conn
+
+def buffer_uploaded_file(uploaded_file):
+    """Copies an UploadedFile into a fresh BytesIO, cursor at 0.
+
+    Goes through getbuffer(), a zero-copy memoryview, so the only allocation
+    is the BytesIO's own backing store — getvalue() would materialize an
+    intermediate bytes object per file on top of that.
+    """
+    buf = io.BytesIO()
+    buf.write(uploaded_file.getbuffer())
+    buf.seek(0)
+    return buf
+
 def get_metadata(file_obj, filename=""):
-    """Extracts metadata from an audio file object."""
-    metadata = {"title": os.path.splitext(filename)[0] if filename else "Unknown Title",
-                "artist": "Unknown Artist",
-                "album": "Unknown Album",
-                "duration": 0,
-                "art": None}
+    """Extracts textual metadata (title/artist/album/duration) from an audio file.
+
+    Deliberately skips embedded pictures — decoding megabyte APIC/FLAC art for
+    every track at ingestion is wasted work when only the current track shows
+    art. Use get_art() lazily for the track that is actually playing.
+
+    Thin wrapper around the cached parser: the cache key is a cheap hash of
+    the first 64 KB plus the total size, so re-uploads and every Streamlit
+    rerun (button clicks, sleep-timer ticks) skip mutagen entirely.
+    """
+    content = _read_content(file_obj)
+    return _get_metadata_cached(_content_key(content), filename, _content=content)
+
+def get_art(file_obj, filename=""):
+    """Extracts embedded cover art as a small PNG thumbnail, or None."""
+    content = _read_content(file_obj)
+    return _get_art_cached(_content_key(content), filename, _content=content)
+
+@st.cache_data(show_spinner=False)
+def _get_art_cached(cache_key, filename, _content):
+    """Parses only the picture frames of an audio file; cached like metadata."""
+    file_obj = io.BytesIO(_content)
+    file_type_hint = filename.lower().split('.')[-1] if filename else None
     try:
-        # Ensure file_obj is seekable and at the beginning
-        if hasattr(file_obj, 'seek'):
-            file_obj.seek(0)
-
-        file_type_hint = filename.lower().split('.')[-1] if filename else None
-
         if file_type_hint == "mp3":
+            from mutagen.mp3 import MP3
             audio = MP3(file_obj)
+            if 'APIC:' in audio:
+                return _thumbnail(audio['APIC:'].data)
         elif file_type_hint == "flac":
+            from mutagen.flac import FLAC
             audio = FLAC(file_obj)
-        elif file_type_hint == "ogg":
-            audio = OggVorbis(file_obj)
-        elif file_type_hint == "wav":
-            audio = WAVE(file_obj)
-        else: # Fallback to generic MutagenFile if type is unknown or not handled above
-            audio = MutagenFile(file_obj, easy=True) # easy=True can simplify tag access
-
-        if not audio: # If MutagenFile couldn't parse it
-            return metadata
-
-        metadata["duration"] = int(audio.info.length)
-
-        if isinstance(audio, MP3):
-            if 'TIT2' in audio: metadata["title"] = str(audio['TIT2'])
-            if 'TPE1' in audio: metadata["artist"] = str(audio['TPE1'])
-            if 'TALB' in audio: metadata["album"] = str(audio['TALB'])
-            if 'APIC:' in audio: metadata["art"] = audio['APIC:'].data
-        elif isinstance(audio, FLAC):
-            if 'title' in audio: metadata["title"] = ", ".join(audio['title'])
-            if 'artist' in audio: metadata["artist"] = ", ".join(audio['artist'])
-            if 'album' in audio: metadata["album"] = ", ".join(audio['album'])
-            if audio.pictures: metadata["art"] = audio.pictures[0].data
-        elif isinstance(audio, OggVorbis): # OggVorbis uses lowercase keys
-            if 'title' in audio: metadata["title"] = ", ".join(audio['title'])
-            if 'artist' in audio: metadata["artist"] = ", ".join(audio['artist'])
-            if 'album' in audio: metadata["album"] = ", ".join(audio['album'])
-        elif isinstance(audio, WAVE): # WAVE metadata is less standard
-            pass # Duration is primary for WAV here
-        elif audio.tags: # For MutagenFile with easy=True
-             if 'title' in audio.tags: metadata["title"] = str(audio.tags['title'][0])
-             if 'artist' in audio.tags: metadata["artist"] = str(audio.tags['artist'][0])
-             if 'album' in audio.tags: metadata["album"] = str(audio.tags['album'][0])
+            if audio.pictures:
+                return _thumbnail(audio.pictures[0].data)
+    except Exception:
+        pass
+    return None
+
+@st.cache_data(show_spinner=False)
+def _get_metadata_cached(cache_key, filename, _content):
+    """Parses metadata from raw audio bytes; cached on (cache_key, filename).
+
+    Two tiers: st.cache_data for the current session, backed by the SQLite
+    cache for repeat uploads across sessions. A broken on-disk cache never
+    breaks ingestion — mutagen just runs again.
+
+    _content is underscore-prefixed so Streamlit keys the cache on the cheap
+    blake2b digest instead of hashing the full file on every call.
+    """
+    db_key = cache_key + hashlib.blake2b(filename.encode(), digest_size=8).digest()
+    try:
+        row = _meta_db().execute("SELECT pickle FROM meta WHERE key=?", (db_key,)).fetchone()
+        if row:
+            return pickle.loads(row[0])
+    except (sqlite3.Error, pickle.PickleError, OSError):
+        pass
+    metadata = _parse_metadata(filename, _content)
+    try:
+        _meta_db().execute("INSERT OR REPLACE INTO meta VALUES(?, ?)",
+                           (db_key, pickle.dumps(metadata)))
+    except (sqlite3.Error, OSError):
+        pass
+    return metadata
 
+def _parse_mp3(file_obj, metadata, filename):
+    from mutagen.mp3 import MP3
+    from mutagen.id3 import ID3NoHeaderError
+    try:
+        audio = MP3(file_obj)
     except ID3NoHeaderError:
-        st.warning(f"File '{filename}' appears to be an MP3 but has no ID3 tags. Using filename as title.")
+        # Parsers run on pool threads where st.* calls have no
+        # ScriptRunContext and get dropped; the diagnostic travels back in
+        # the metadata dict and the main thread shows it after ingestion.
+        metadata["warning"] = f"File '{filename}' appears to be an MP3 but has no ID3 tags. Using filename as title."
+        return
+    metadata["duration"] = int(audio.info.length)
+    # .text[0] reads the frame value directly, skipping the
+    # list-join/normalization work in the frame's __str__.
+    if 'TIT2' in audio: metadata["title"] = audio['TIT2'].text[0]
+    if 'TPE1' in audio: metadata["artist"] = audio['TPE1'].text[0]
+    if 'TALB' in audio: metadata["album"] = audio['TALB'].text[0]
+
+def _copy_vorbis_tags(audio, metadata):
+    """Copies the common Vorbis comments (lowercase keys) into metadata."""
+    if 'title' in audio: metadata["title"] = ", ".join(audio['title'])
+    if 'artist' in audio: metadata["artist"] = ", ".join(audio['artist'])
+    if 'album' in audio: metadata["album"] = ", ".join(audio['album'])
+
+def _parse_flac(file_obj, metadata, filename):
+    from mutagen.flac import FLAC
+    audio = FLAC(file_obj)
+    metadata["duration"] = int(audio.info.length)
+    _copy_vorbis_tags(audio, metadata)
+
+def _parse_ogg(file_obj, metadata, filename):
+    from mutagen.oggvorbis import OggVorbis
+    audio = OggVorbis(file_obj)
+    metadata["duration"] = int(audio.info.length)
+    _copy_vorbis_tags(audio, metadata)
+
+def _parse_wav(file_obj, metadata, filename):
+    from mutagen.wave import WAVE
+    audio = WAVE(file_obj)
+    metadata["duration"] = int(audio.info.length) # WAVE metadata is less standard; duration is primary
+
+def _parse_generic(file_obj, metadata, filename):
+    from mutagen import File as MutagenFile
+    audio = MutagenFile(file_obj, easy=True) # easy=True can simplify tag access
+    if not audio: # If MutagenFile couldn't parse it
+        return
+    metadata["duration"] = int(audio.info.length)
+    if audio.tags:
+        if 'title' in audio.tags: metadata["title"] = str(audio.tags['title'][0])
+        if 'artist' in audio.tags: metadata["artist"] = str(audio.tags['artist'][0])
+        if 'album' in audio.tags: metadata["album"] = str(audio.tags['album'][0])
+
+# Extension → parser table; one dispatch per file instead of an if/elif
+# cascade on the hint followed by a second isinstance-style cascade.
+_PARSERS = {'mp3': _parse_mp3, 'flac': _parse_flac, 'ogg': _parse_ogg, 'wav': _parse_wav}
+
+def _parse_metadata(filename, content):
+    """Runs mutagen over raw audio bytes and returns the metadata dict."""
+    file_obj = io.BytesIO(content)
+    metadata = {"title": os.path.splitext(filename)[0] if filename else "Unknown Title",
+                "artist": "Unknown Artist",
+                "album": "Unknown Album",
+                "duration": 0,
+                "art": None}
+    file_type_hint = filename.lower().split('.')[-1] if filename else None
+    try:
+        _PARSERS.get(file_type_hint, _parse_generic)(file_obj, metadata, filename)
     except Exception as e:
-        st.debug(f"Could not read metadata for '{filename}': {e}") # More detailed debug
-    finally:
-        if hasattr(file_obj, 'seek'): # Reset cursor for potential reuse
-            file_obj.seek(0)
+        # Expected for truncated head-only URL fetches (e.g. a FLAC whose
+        # picture block extends past the fetched slice) — fall back to the
+        # filename-based defaults rather than failing the add.
+        logger.debug("Could not read metadata for '%s': %s", filename, e)
     return metadata
 
+@functools.lru_cache(maxsize=512)
+def _fmt_duration(seconds):
+    """Formats a non-negative integer second count as MM:SS; memoized."""
+    minutes, secs = divmod(seconds, 60)
+    return f"{minutes:02d}:{secs:02d}"
+
 def format_duration(seconds):
     """Formats seconds into MM:SS string."""
     if seconds is None or not isinstance(seconds, (int, float)) or seconds < 0:
         return "--:--"
-    minutes = int(seconds // 60)
-    secs = int(seconds % 60)
-    return f"{minutes:02d}:{secs:02d}"
-
-def fetch_url_content(url):
-    """Fetches content from a URL, returns BytesIO object and filename."""
+    return _fmt_duration(int(seconds))
+
+def bulk_format_durations(durations):
+    """Formats a whole playlist's durations in one pass.
+
+    Track durations repeat rarely but the values are small integers, so the
+    lru_cache behind _fmt_duration absorbs repeats across reruns; a single
+    list comprehension beats calling the guarded public function per row.
+    """
+    return [_fmt_duration(int(s)) if isinstance(s, (int, float)) and s >= 0 else "--:--"
+            for s in durations]
+
+@st.cache_resource(show_spinner=False)
+def _http_session():
+    """Shared HTTP session with connection pooling and keep-alive.
+
+    A fresh requests.get pays a TCP+TLS handshake per URL; reusing one
+    session means repeat adds from the same host (CDNs, podcast feeds) skip
+    the handshake entirely.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def fetch_url_content(url, head_only=False):
+    """Fetches content from a URL, returns (BytesIO, filename, is_partial).
+
+    With head_only=True only the first 128 KB is requested via an HTTP Range
+    header — enough for ID3v2/Vorbis comment blocks, which live at the start
+    of the file. Servers that ignore Range simply return the full body.
+    is_partial tells the caller whether the body was truncated (206 response
+    whose Content-Range total exceeds what was fetched), in which case
+    size-derived fields like an MP3's estimated duration are meaningless.
+    """
+    import requests
     try:
-        response = requests.get(url, stream=True, timeout=10)
+        headers = {'Range': 'bytes=0-131071'} if head_only else None
+        response = _http_session().get(url, headers=headers, stream=True, timeout=10)
         response.raise_for_status()
-        content = io.BytesIO(response.content)
+        body = response.content
+        is_partial = False
+        if response.status_code == 206:
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            is_partial = not (total.isdigit() and int(total) <= len(body))
+        content = io.BytesIO(body)
         filename = url.split('/')[-1].split('?')[0]
         if not filename: # If URL ends with / or has no clear filename part
             filename = "audio_from_url"
-        return content, filename
+        return content, filename, is_partial
     except requests.exceptions.RequestException as e:
         st.error(f"Error fetching URL '{url}': {e}")
-        return None, None
+        return None, None, False
+
+@st.fragment(run_every=1.0)
+def _sleep_timer_status():
+    """Countdown display and expiry check for the sleep timer.
+
+    As a fragment with run_every, only this block reruns each second while a
+    timer is armed — the playlist, widgets and CSS of the main page are left
+    untouched until the timer actually fires.
+    """
+    if not (st.session_state.sleep_timer_active
+            and st.session_state.sleep_timer_deadline_mono is not None):
+        return
+    remaining_secs = int(st.session_state.sleep_timer_deadline_mono - time.monotonic())
+    if remaining_secs > 0:
+        hours, rem = divmod(remaining_secs, 3600)
+        minutes, secs = divmod(rem, 60)
+        st.info(f"Stopping in: {hours}:{minutes:02d}:{secs:02d}")
+    else:
+        st.session_state.sleep_timer_active = False
+        st.session_state.sleep_timer_deadline_mono = None
+        st.session_state.current_track_index = -1 # Stop playback
+        st.session_state.set_sleep_minutes = 0 # Reset timer input
+        st.warning("😴 Sleep timer finished. Playback stopped.")
+        st.rerun(scope="app") # Full rerun to reflect the stopped state
 
 # --- Session State Initialization ---
 default_states = {
     'playlist': [],
+    'playlist_names': set(),  # O(1) duplicate check for uploaded files
+    'playlist_urls': set(),   # O(1) duplicate check for URL sources
     'current_track_index': -1,
     'sleep_timer_active': False,
-    'sleep_timer_end_time': None,
+    'sleep_timer_deadline_mono': None,  # time.monotonic() deadline, immune to clock jumps
     'autoplay_next': True,
     'shuffle_mode': False,
+    'shuffle_queue': [],  # Upcoming indices; no repeats until every track has played
     'loop_current_track': False,
     'upload_method': 'Upload Audio Files' # Default upload method
 }
@@ -119,7 +337,9 @@ for key, value in default_states.items():
         st.session_state[key] = value
 
 # --- Custom CSS ---
-st.markdown("""
+# Built once at import as a constant; st.html is cached client-side, so the
+# stylesheet is not re-diffed over the websocket on every rerun.
+_CSS = """
 <style>
     /* ... [Same CSS as before or your preferred styling] ... */
     .stApp {}
@@ -128,25 +348,11 @@ st.markdown("""
     .song-info { padding: 15px; border-radius: 10px; background-color: #e9ecef; margin-bottom: 20px; text-align: center; }
     .song-title { font-size: 1.5em; font-weight: bold; color: #333; }
     .song-artist-album { font-size: 1.1em; color: #555; }
-    .playlist-item-button {
-        width: 100%;
-        text-align: left;
-        padding: 10px;
-        border: 1px solid transparent; /* For consistent height */
-        background-color: transparent;
-    }
-    .playlist-item-button:hover {
-        background-color: #f0f0f0;
-        border-color: #ddd;
-    }
-    .current-playlist-item .playlist-item-button {
-        background-color: #d0e0f0; /* Highlight current track */
-        font-weight: bold;
-        border-color: #b0c0d0;
-    }
     .album-art { max-width: 200px; max-height: 200px; border-radius: 8px; margin: auto; display: block; box-shadow: 0 4px 8px rgba(0,0,0,0.1); }
+    .no-album-art { height: 200px; display: flex; align-items: center; justify-content: center; background-color: #f0f0f0; border-radius: 8px; color: #aaa; }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.html(_CSS)
 
 
 # --- Sidebar ---
@@ -168,19 +374,38 @@ with st.sidebar:
             key="file_uploader_key" # Add a key for stability if needed
         )
         if uploaded_files:
-            new_files_added_count = 0
-            for uploaded_file in uploaded_files:
-                if not any(item['name'] == uploaded_file.name for item in st.session_state.playlist):
-                    file_bytes_main = io.BytesIO(uploaded_file.getvalue()) # For playback
-                    file_bytes_meta = io.BytesIO(uploaded_file.getvalue()) # Fresh BytesIO for metadata
-                    metadata = get_metadata(file_bytes_meta, uploaded_file.name)
+            new_files = [f for f in uploaded_files
+                         if f.name not in st.session_state.playlist_names]
+            new_files_added_count = len(new_files)
+            if new_files:
+                # One buffer per file, shared between metadata parsing and
+                # playback; get_metadata seeks back to 0 when done. Parsing
+                # runs in a thread pool — mutagen is I/O bound and releases
+                # the GIL during reads, so a 50-file folder doesn't stall
+                # the UI. Session state is only touched serially afterwards.
+                buffers = [buffer_uploaded_file(f) for f in new_files]
+                with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+                    metadatas = list(executor.map(
+                        get_metadata, buffers, [f.name for f in new_files]))
+                duration_strs = bulk_format_durations(
+                    m.get('duration', 0) for m in metadatas)
+                for uploaded_file, file_buffer, metadata, duration_str in zip(
+                        new_files, buffers, metadatas, duration_strs):
+                    # Diagnostics collected on pool threads surface here,
+                    # back on the main thread with a ScriptRunContext.
+                    if metadata.get('warning'):
+                        st.warning(metadata['warning'])
+                    file_buffer.seek(0) # Ready for playback
                     st.session_state.playlist.append({
-                        'source': file_bytes_main,
+                        'source': file_buffer,
                         'metadata': metadata,
                         'type': 'file',
-                        'name': uploaded_file.name
+                        'name': uploaded_file.name,
+                        'mime': get_mime_type(uploaded_file.name),
+                        'label': f"{len(st.session_state.playlist) + 1}. "
+                                 f"{metadata.get('title', uploaded_file.name)} ({duration_str})"
                     })
-                    new_files_added_count += 1
+                    st.session_state.playlist_names.add(uploaded_file.name)
             if new_files_added_count > 0:
                 st.success(f"Added {new_files_added_count} new file(s) to playlist!")
                 if st.session_state.current_track_index == -1 and st.session_state.playlist:
@@ -191,19 +416,31 @@ with st.sidebar:
     elif st.session_state.upload_method == 'Enter Audio URL':
         url_input = st.text_input("Enter direct audio URL (e.g., link to .mp3)")
         if st.button("Add from URL") and url_input:
-            if not any(item['source'] == url_input for item in st.session_state.playlist if item['type'] == 'url'):
-                # For URLs, full metadata extraction downloads the file.
-                # Consider a lighter approach if this is too slow, e.g., just filename.
-                content_for_meta, filename_from_url = fetch_url_content(url_input)
+            if url_input not in st.session_state.playlist_urls:
+                # Only the file header is needed for metadata; st.audio streams
+                # the URL itself, so never download the full file here.
+                content_for_meta, filename_from_url, is_partial = fetch_url_content(url_input, head_only=True)
                 if content_for_meta:
                     metadata = get_metadata(content_for_meta, filename_from_url)
+                    if metadata.get('warning'):
+                        st.warning(metadata['warning'])
+                    if is_partial:
+                        # MP3 durations are estimated from stream size, so a
+                        # truncated fetch yields nonsense; show --:-- instead.
+                        metadata['duration'] = None
+                    display_name = filename_from_url if filename_from_url else url_input
                     st.session_state.playlist.append({
                         'source': url_input, # Store URL string for st.audio
                         'metadata': metadata,
                         'type': 'url',
-                        'name': filename_from_url if filename_from_url else url_input
+                        'name': display_name,
+                        'mime': get_mime_type(filename_from_url),
+                        'label': f"{len(st.session_state.playlist) + 1}. "
+                                 f"{metadata.get('title', display_name)} "
+                                 f"({format_duration(metadata.get('duration', 0))})"
                     })
-                    st.success(f"Added '{filename_from_url if filename_from_url else url_input}' to playlist!")
+                    st.session_state.playlist_urls.add(url_input)
+                    st.success(f"Added '{display_name}' to playlist!")
                     if st.session_state.current_track_index == -1 and st.session_state.playlist:
                         st.session_state.current_track_index = 0
                 # No else here, fetch_url_content already shows error
@@ -222,21 +459,16 @@ with st.sidebar:
     col1_sleep, col2_sleep = st.columns(2)
     if col1_sleep.button("Start Sleep Timer", disabled=(sleep_minutes == 0), use_container_width=True):
         st.session_state.sleep_timer_active = True
-        st.session_state.sleep_timer_end_time = datetime.now() + timedelta(minutes=sleep_minutes)
+        st.session_state.sleep_timer_deadline_mono = time.monotonic() + sleep_minutes * 60
         st.session_state.set_sleep_minutes = sleep_minutes # Remember value
         st.success(f"Sleep timer set for {sleep_minutes} minutes.")
     if col2_sleep.button("Cancel Sleep Timer", disabled=not st.session_state.sleep_timer_active, use_container_width=True):
         st.session_state.sleep_timer_active = False
-        st.session_state.sleep_timer_end_time = None
+        st.session_state.sleep_timer_deadline_mono = None
         st.session_state.set_sleep_minutes = 0 # Reset
         st.info("Sleep timer cancelled.")
 
-    if st.session_state.sleep_timer_active and st.session_state.sleep_timer_end_time:
-        remaining_time = st.session_state.sleep_timer_end_time - datetime.now()
-        if remaining_time.total_seconds() > 0:
-            st.info(f"Stopping in: {str(timedelta(seconds=int(remaining_time.total_seconds())))}")
-        else: # Timer might have just expired
-            st.info("Sleep timer active but end time reached.")
+    _sleep_timer_status()
 
 
 # --- Main Area ---
@@ -247,24 +479,18 @@ if not st.session_state.playlist:
 else:
     # --- Playlist Display and Selection ---
     st.subheader("📜 Playlist / Queue")
-    # Using st.container for better layout control if needed, and custom styling for items
-    playlist_container = st.container()
-    with playlist_container:
-        for i, track in enumerate(st.session_state.playlist):
-            track_name_display = f"{i + 1}. {track['metadata'].get('title', track['name'])}"
-            is_current = (i == st.session_state.current_track_index)
-
-            # Use a div styled as a button via markdown for better control over appearance if st.button is limiting
-            item_class = "playlist-item-button-wrapper" # For potential outer styling
-            if is_current:
-                item_class += " current-playlist-item"
-
-            # Use actual st.button for interactivity
-            # We assign a unique key to each button in the playlist
-            if st.button(track_name_display, key=f"playlist_track_{i}", use_container_width=True,
-                         help=f"Play: {track['metadata'].get('title', track['name'])}"):
-                st.session_state.current_track_index = i
-                # Autoplay will be handled by st.audio based on st.session_state.autoplay_next
+    # A single selectbox instead of one st.button per track: widget count and
+    # DOM payload stay O(1) no matter how long the playlist gets.
+    # Labels are precomputed at ingestion; the render path just collects them.
+    track_labels = [track['label'] for track in st.session_state.playlist]
+    selected_index = st.selectbox(
+        "Select a track to play:",
+        range(len(track_labels)),
+        format_func=lambda i: track_labels[i],
+        index=max(0, st.session_state.current_track_index)
+    )
+    st.session_state.current_track_index = selected_index
+    # Autoplay will be handled by st.audio based on st.session_state.autoplay_next
 
     # --- Current Song Info and Player ---
     if 0 <= st.session_state.current_track_index < len(st.session_state.playlist):
@@ -276,6 +502,11 @@ else:
 
         info_cols = st.columns([1,2]) # Album Art (optional), Text Info
 
+        # Art is extracted lazily, only for the track actually on screen.
+        if current_track_data['type'] == 'file' and not metadata.get('art_loaded'):
+            metadata['art'] = get_art(current_track_data['source'], current_track_data['name'])
+            metadata['art_loaded'] = True
+
         with info_cols[0]:
             if metadata.get("art"):
                 try:
@@ -286,30 +517,29 @@ else:
                 except Exception as e:
                     st.caption("Art display error.")
             else:
-                st.markdown("<div style='height: 200px; display: flex; align-items: center; justify-content: center; background-color: #f0f0f0; border-radius: 8px; color: #aaa;'>No Album Art</div>", unsafe_allow_html=True)
+                st.markdown("<div class='no-album-art'>No Album Art</div>", unsafe_allow_html=True)
 
 
         with info_cols[1]:
-            st.markdown(f"<div class='song-title'>{metadata.get('title', 'Unknown Title')}</div>", unsafe_allow_html=True)
-            st.markdown(f"<div class='song-artist-album'>🎤 Artist: {metadata.get('artist', 'Unknown Artist')}</div>", unsafe_allow_html=True)
-            st.markdown(f"<div class='song-artist-album'>📀 Album: {metadata.get('album', 'Unknown Album')}</div>", unsafe_allow_html=True)
-            st.markdown(f"<div class='song-artist-album'>⏱️ Duration: {format_duration(metadata.get('duration', 0))}</div>", unsafe_allow_html=True)
+            # One markdown element (one websocket frame) for all four lines.
+            st.markdown(
+                f"<div class='song-title'>{metadata.get('title', 'Unknown Title')}</div>"
+                f"<div class='song-artist-album'>🎤 Artist: {metadata.get('artist', 'Unknown Artist')}</div>"
+                f"<div class='song-artist-album'>📀 Album: {metadata.get('album', 'Unknown Album')}</div>"
+                f"<div class='song-artist-album'>⏱️ Duration: {format_duration(metadata.get('duration', 0))}</div>",
+                unsafe_allow_html=True)
 
         # --- Audio Player Element ---
-        audio_source = current_track_data['source']
-        audio_data_to_play = audio_source.getvalue() if isinstance(audio_source, io.BytesIO) else audio_source
-
-        audio_format = "audio/basic" # Let Streamlit infer, or be more specific
-        if isinstance(current_track_data['name'], str):
-            ext = current_track_data['name'].lower().split('.')[-1]
-            if ext == "mp3": audio_format = "audio/mpeg"
-            elif ext == "wav": audio_format = "audio/wav"
-            elif ext == "ogg": audio_format = "audio/ogg"
-            elif ext == "flac": audio_format = "audio/flac" # Add FLAC format
+        # st.audio accepts file-like objects and caches the data by hash
+        # internally; handing it the buffer directly avoids copying the whole
+        # file into a fresh bytes object on every rerun.
+        audio_data_to_play = current_track_data['source']
+        if isinstance(audio_data_to_play, io.BytesIO):
+            audio_data_to_play.seek(0)
 
         st.audio(
             audio_data_to_play,
-            format=audio_format,
+            format=current_track_data['mime'], # Precomputed at ingestion
             start_time=0,
             autoplay=st.session_state.autoplay_next, # Autoplay if new track and enabled
             loop=st.session_state.loop_current_track # Loop current track if enabled
@@ -333,9 +563,16 @@ else:
                 if st.session_state.playlist:
                     if st.session_state.shuffle_mode:
                         if len(st.session_state.playlist) > 1:
-                            new_idx = st.session_state.current_track_index
-                            while new_idx == st.session_state.current_track_index:
-                                new_idx = random.randint(0, len(st.session_state.playlist) - 1)
+                            queue = st.session_state.shuffle_queue
+                            # Rebuild a full shuffled cycle when exhausted or
+                            # when the playlist has changed underneath it.
+                            if not queue or any(i >= len(st.session_state.playlist) for i in queue):
+                                queue = random.sample(range(len(st.session_state.playlist)),
+                                                      len(st.session_state.playlist))
+                            new_idx = queue.pop()
+                            if new_idx == st.session_state.current_track_index and queue:
+                                new_idx = queue.pop()
+                            st.session_state.shuffle_queue = queue
                             st.session_state.current_track_index = new_idx
                         # If only 1 song, shuffle does nothing, current index remains
                     else: # Serial mode
@@ -343,23 +580,6 @@ else:
                             st.session_state.current_track_index += 1
                         else: # Loop to first track
                             st.session_state.current_track_index = 0
-    else:
-        if st.session_state.playlist:
-            st.info("Select a track from the playlist to start, or the first track will load if autoplay is on.")
-            # Auto-select first track if not already selected and playlist exists
-            if st.session_state.current_track_index == -1:
-                 st.session_state.current_track_index = 0
-                 st.experimental_rerun() # Rerun to load and play the first track
-
-# --- Sleep Timer Logic ---
-if st.session_state.sleep_timer_active and st.session_state.sleep_timer_end_time:
-    if datetime.now() >= st.session_state.sleep_timer_end_time:
-        st.session_state.sleep_timer_active = False
-        st.session_state.sleep_timer_end_time = None
-        st.session_state.current_track_index = -1 # Stop playback
-        st.session_state.set_sleep_minutes = 0 # Reset timer input
-        st.warning("😴 Sleep timer finished. Playback stopped.")
-        st.experimental_rerun() # Rerun to reflect the stopped state
 
 # --- Footer ---
 st.markdown("---")